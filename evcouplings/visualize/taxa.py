@@ -6,11 +6,26 @@ Authors:
   Mrunali Manjrekar
 """
 
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from weakref import WeakKeyDictionary
+
+import numpy as np
 import pandas as pd
-import plotly.express as px
+import plotly.graph_objects as go
 
 from ete3 import NCBITaxa # another import
 
+# Arrow-backed strings make .str operations vectorized and compact,
+# but they need pyarrow (optional) and pandas >= 1.3 to resolve the
+# dtype, so otherwise fall back to the default string storage
+try:
+    import pyarrow  # noqa: F401
+    _STRING_DTYPE = pd.api.types.pandas_dtype("string[pyarrow]")
+except (ImportError, TypeError):
+    _STRING_DTYPE = "string"
+
 COLOR_DISCRETE_MAP =    {'Bacteria':'#56B4E9',  # blue
                         'Eukaryota':'#D53500',  # red
                         'Archaea':'#E69F00',    # orange
@@ -21,76 +36,491 @@ SUNBURST_HIERARCHY = ['superkingdom', "phylum", "order"]
 
 PATH_TO_NCBI_TAXA_DATABASE = "/n/groups/marks/databases/etetoolkit/taxa.sqlite" # TODO: add to O2
 
+# suggested location for the (opt-in) persistent cache of
+# tax ID -> lineage lookups, to be passed as cache_file
+TAXONOMY_CACHE_FILE = os.path.expanduser(
+    "~/.cache/evcouplings/taxa_lineage.sqlite"
+)
+
+# below this number of tax IDs, lookups are run serially
+# since the thread pool overhead outweighs overlapping queries
+PARALLEL_LOOKUP_THRESHOLD = 1000
+
+# maximum number of tax IDs bound into a single "IN (...)" clause,
+# keeps queries below the sqlite host parameter limit
+SQL_CHUNK_SIZE = 500
+
+TAXONOMY_RANKS = ['superkingdom',
+                  'phylum',
+                  'genus',
+                  'class',
+                  'subphylum',
+                  'family',
+                  'order',
+                  'species']
 
-def load_taxonomy_lineage(tax_ids, ncbi):
+# for fast membership tests when filtering lineages
+_RANKS = frozenset(TAXONOMY_RANKS)
+
+
+# NCBITaxa instances by database file, created on first use
+_NCBI_CACHE = {}
+
+
+def _get_ncbi(database_file):
     """
-    Using NCBITaxa, querying all the taxonomic information on the 
-    species' proteins included in the alignment.
+    Get (shared) NCBITaxa instance for a taxonomy database,
+    so the database is only opened once per process
+    """
+    if database_file not in _NCBI_CACHE:
+        _NCBI_CACHE[database_file] = NCBITaxa(dbfile=database_file)
+
+    return _NCBI_CACHE[database_file]
+
+
+# per NCBITaxa instance: (database key, {tax ID: lineage}) of
+# per-ID lookups; weak, so instances and their connections are
+# not kept alive by the cache
+_LINEAGE_CACHE = WeakKeyDictionary()
 
 
+def _chunked(items, size):
+    """
+    Split a list into consecutive chunks of at most size elements
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _lineage_for(tax_id, ncbi, database_key):
+    """
+    Query ranks of interest in the lineage of a single tax ID
+    using the NCBITaxa API. Results are cached in memory so
+    repeated IDs do not hit the database again.
+
+    Parameters
+    ----------
+    tax_id : int
+        NCBI Taxonomy ID
+    ncbi : NCBITaxa() instance
+        Instance used for querying
+    database_key : str
+        Current version of the database of ncbi (cf. _database_key);
+        cached lineages of the instance are discarded when it changes
+
+    Returns
+    -------
+    tuple
+        (rank, name) pairs for all ranks of interest in lineage
+    """
+    cached_key, lineages = _LINEAGE_CACHE.get(ncbi, (None, None))
+    if cached_key != database_key:
+        lineages = {}
+        _LINEAGE_CACHE[ncbi] = (database_key, lineages)
+
+    if tax_id not in lineages:
+        lineage = ncbi.get_lineage(tax_id)
+        name_dict = ncbi.get_taxid_translator(lineage)
+        # dict: key=lineageid, value=sequence value
+
+        rank_dict = ncbi.get_rank(lineage)
+
+        # single pass over lineage, keeping only ranks of interest
+        lineages[tax_id] = tuple(
+            (rank, name_dict[lineage_id])
+            for lineage_id, rank in rank_dict.items() if rank in _RANKS
+        )
+
+    return lineages[tax_id]
+
+
+def _query_lineages_ete3(tax_ids, ncbi):
+    """
+    Query the lineage of tax IDs one by one using the NCBITaxa API.
+
+    Used as a fallback for IDs that cannot be found directly in the
+    species table (e.g. tax IDs that were merged into another ID,
+    which NCBITaxa resolves).
+
     Parameters
     ----------
     tax_ids : Python list
         1D list of NCBI Taxonomy IDs.
-
     ncbi : NCBITaxa() instance
-        An instance that only gets created if get_taxa gets called; that is, the
-        the user wants to query the taxonomic ranks for a set of sequences 
-        to visualize species diversity or for other purposes. 
-
+        Instance used for querying
 
     Returns
     -------
-    rank_sequencevalue_hm : pd.DataFrame
-        dataframe with columns making up all taxonomic ranks
-        covered by NCBI. These ranks are: 
-        'superkingdom': 
-        'phylum': 
-        'genus': 
-        'class':
-        'subphylum': 
-        'family': 
-        'order': 
-        'species': 
-
-    """
-    # TODO: update the docstring
-    ranks = ['superkingdom', 
-            'phylum', 
-            'genus', 
-            'class', 
-            'subphylum', 
-            'family', 
-            'order', 
-            'species']
-
-    taxs = []
+    taxs : pd.DataFrame
+        Lineages of all successfully queried tax IDs,
+        indexed by tax_ID with one column per rank
+    """
+    # fill preallocated columns rather than growing lists row by row
+    n = len(tax_ids)
+    found_ids = [None] * n
+    rank_values = {r: [None] * n for r in TAXONOMY_RANKS}
+    i = 0
+
+    database_key = _database_key(ncbi.dbfile)
 
     for tax_id in tax_ids:
         try:
-            lineage = ncbi.get_lineage(int(tax_id))
-            name_dict = ncbi.get_taxid_translator(lineage) 
-            # dict: key=lineageid, value=sequence value
-            
-            rank_dict = ncbi.get_rank(lineage)
-            # flipping the keys and entries of the dictionary.
-            lineage_dict = dict((rank_dict[i], name_dict[i]) for i in lineage)
+            for rank, name in _lineage_for(tax_id, ncbi, database_key):
+                rank_values[rank][i] = name
 
-            lineage_dict = {k: lineage_dict[k] for k in ranks if k in lineage_dict}
-
-            # add at end so that it doesn't get prematurely added. 
-            lineage_dict['tax_ID'] = tax_id
-
-            taxs.append(lineage_dict)
+            found_ids[i] = tax_id
+            i += 1
 
         except ValueError as e:
             print('Warning: {0}'.format(str(e)))
             # TODO: consider whether you should adjust this depending on database type.
             # TODO: create test cases? hm
-    return pd.DataFrame.from_dict(taxs)
 
+    # drop unused slots left by failed lookups
+    return pd.DataFrame(
+        {r: values[:i] for r, values in rank_values.items()},
+        index=pd.Index(found_ids[:i], name="tax_ID", dtype="int64"),
+        columns=TAXONOMY_RANKS
+    )
+
+
+def _lineage_frame(taxs):
+    """
+    Turn a list of lineage dictionaries into a dataframe
+    indexed by tax_ID with one column per rank
+    """
+    return pd.DataFrame.from_records(
+        taxs, columns=["tax_ID"] + TAXONOMY_RANKS
+    ).astype({"tax_ID": "int64"}).set_index("tax_ID")
+
+
+def _read_sql_chunked(con, query, ids, params=()):
+    """
+    Run a query with an "IN ({})" placeholder for chunks
+    of IDs and concatenate the results into one dataframe
+    """
+    # for no IDs, run query once with an empty "IN ()" clause
+    # (valid in sqlite), so result has the columns of the query
+    chunks = _chunked(ids, SQL_CHUNK_SIZE) or [[]]
+
+    return pd.concat([
+        pd.read_sql(
+            query.format(",".join("?" * len(chunk))),
+            con, params=list(chunk) + list(params)
+        )
+        for chunk in chunks
+    ], ignore_index=True)
+
+
+def _query_lineages(tax_ids, database_file):
+    """
+    Query the lineage of tax IDs in bulk from the NCBITaxa
+    sqlite database.
+
+    Rather than issuing several queries per tax ID, lineages
+    are fetched from the "track" column of the species table for
+    all IDs at once, followed by a single lookup of names and
+    ranks for all ancestors. Lineages are then assembled with
+    vectorized pandas operations rather than a per-ID loop.
+
+    Parameters
+    ----------
+    tax_ids : Python list
+        1D list of NCBI Taxonomy IDs.
+    database_file : str
+        Path to NCBITaxa sqlite database. Every call opens its
+        own connection, so this function can be run in threads.
+
+    Returns
+    -------
+    taxs : pd.DataFrame
+        Lineages of all tax IDs found in the species table,
+        indexed by tax_ID with one column per rank
+    missing : Python list
+        Tax IDs that were not found in the species table
+    """
+    if len(tax_ids) == 0:
+        return _lineage_frame([]), []
+
+    con = sqlite3.connect(database_file)
+    try:
+        tracks = _read_sql_chunked(
+            con, "SELECT taxid AS tax_ID, track FROM species WHERE taxid IN ({})",
+            tax_ids
+        )
+
+        # none of the IDs is in the species table
+        if len(tracks) == 0:
+            return _lineage_frame([]), list(tax_ids)
+
+        # long format, one row per (tax_ID, ancestor_id) pair
+        lineages = tracks.assign(
+            ancestor_id=tracks["track"].str.split(",")
+        ).explode("ancestor_id")[["tax_ID", "ancestor_id"]]
+        lineages["ancestor_id"] = lineages["ancestor_id"].astype("int64")
+
+        # names of all ancestors, restricted to ranks of interest
+        ancestors = _read_sql_chunked(
+            con,
+            "SELECT taxid AS ancestor_id, rank, spname FROM species "
+            "WHERE taxid IN ({{}}) AND rank IN ({})".format(
+                ",".join("?" * len(TAXONOMY_RANKS))
+            ),
+            lineages["ancestor_id"].unique().tolist(),
+            params=TAXONOMY_RANKS
+        )
+    finally:
+        con.close()
+
+    taxs = lineages.merge(
+        ancestors, on="ancestor_id"
+    ).drop_duplicates(
+        ["tax_ID", "rank"]
+    ).pivot(
+        index="tax_ID", columns="rank", values="spname"
+    ).reindex(
+        # IDs without any rank of interest are kept as empty rows
+        index=pd.Index(tracks["tax_ID"].unique(), name="tax_ID"),
+        columns=TAXONOMY_RANKS
+    )
+    taxs.columns.name = None
+
+    found = set(tracks["tax_ID"].tolist())
+    missing = [tax_id for tax_id in tax_ids if tax_id not in found]
+
+    return taxs, missing
+
+
+def _database_key(database_file):
+    """
+    Identify a version of a taxonomy database in the lineage cache
+    by its path and modification time, so updating or switching
+    databases does not return stale lineages
+    """
+    return "{}:{}".format(
+        os.path.abspath(database_file), os.path.getmtime(database_file)
+    )
+
+
+def _read_lineage_cache(tax_ids, cache_file, database_file):
+    """
+    Look up previously queried lineages in the persistent cache.
+
+    The cache is best-effort: if it cannot be read (e.g. because
+    it is locked by another job), all IDs are reported as missing.
+
+    Parameters
+    ----------
+    tax_ids : Python list
+        1D list of NCBI Taxonomy IDs.
+    cache_file : str
+        Path to sqlite cache file (does not need to exist)
+    database_file : str
+        Path to NCBITaxa sqlite database the lineages were queried from
+
+    Returns
+    -------
+    taxs : pd.DataFrame
+        Lineages of all cached tax IDs, indexed by
+        tax_ID with one column per rank
+    missing : Python list
+        Tax IDs that are not in the cache
+    """
+    if not os.path.exists(cache_file) or len(tax_ids) == 0:
+        return _lineage_frame([]), list(tax_ids)
+
+    # note that pandas wraps sqlite errors in read_sql into
+    # its own DatabaseError, which is a subclass of OSError
+    try:
+        con = sqlite3.connect(cache_file)
+        try:
+            taxs = _read_sql_chunked(
+                con,
+                "SELECT tax_ID, {} FROM lineage "
+                "WHERE tax_ID IN ({{}}) AND database = ?".format(
+                    ", ".join('"{}"'.format(r) for r in TAXONOMY_RANKS)
+                ),
+                tax_ids,
+                params=[_database_key(database_file)]
+            ).set_index("tax_ID")
+        finally:
+            con.close()
+    except (sqlite3.Error, OSError) as e:
+        print('Warning: could not read lineage cache: {0}'.format(str(e)))
+        return _lineage_frame([]), list(tax_ids)
+
+    found = set(taxs.index.tolist())
+    missing = [tax_id for tax_id in tax_ids if tax_id not in found]
+
+    return taxs, missing
+
+
+def _write_lineage_cache(taxs, cache_file, database_file):
+    """
+    Add newly queried lineages to the persistent cache.
+
+    The cache is best-effort: if it cannot be written (e.g.
+    read-only file system), a warning is printed and lineages
+    are simply not cached.
+
+    Parameters
+    ----------
+    taxs : pd.DataFrame
+        Lineages indexed by tax_ID, with one column per rank
+    cache_file : str
+        Path to sqlite cache file, will be created
+        if it does not exist yet
+    database_file : str
+        Path to NCBITaxa sqlite database the lineages were queried from
+    """
+    if len(taxs) == 0:
+        return
+
+    columns = ", ".join('"{}"'.format(r) for r in TAXONOMY_RANKS)
+    database = _database_key(database_file)
+
+    try:
+        os.makedirs(
+            os.path.dirname(os.path.abspath(cache_file)), exist_ok=True
+        )
 
-def get_taxa(annotation, aln_format, database_file=PATH_TO_NCBI_TAXA_DATABASE):
+        con = sqlite3.connect(cache_file)
+        try:
+            with con:
+                con.execute(
+                    "CREATE TABLE IF NOT EXISTS lineage "
+                    "(database TEXT, tax_ID INTEGER, {}, "
+                    "PRIMARY KEY (database, tax_ID))".format(
+                        ", ".join('"{}" TEXT'.format(r) for r in TAXONOMY_RANKS)
+                    )
+                )
+                con.executemany(
+                    "INSERT OR REPLACE INTO lineage "
+                    "(database, tax_ID, {}) VALUES ({})".format(
+                        columns, ",".join("?" * (len(TAXONOMY_RANKS) + 2))
+                    ),
+                    # store missing ranks as NULL
+                    (
+                        (database,) + row for row in taxs.astype(object).where(
+                            taxs.notna(), None
+                        ).itertuples(name=None)
+                    )
+                )
+        finally:
+            con.close()
+    except (sqlite3.Error, OSError) as e:
+        print('Warning: could not write lineage cache: {0}'.format(str(e)))
+
+
+def load_taxonomy_lineage(tax_ids, ncbi, cache_file=None):
+    """
+    Using NCBITaxa, querying all the taxonomic information on the 
+    species' proteins included in the alignment.
+
+
+    Parameters
+    ----------
+    tax_ids : array-like
+        1D list or numpy array of NCBI Taxonomy IDs.
+
+    ncbi : NCBITaxa() instance
+        An instance that only gets created if get_taxa gets called; that is, the
+        the user wants to query the taxonomic ranks for a set of sequences 
+        to visualize species diversity or for other purposes. 
+
+    cache_file : str, optional (default: None)
+        sqlite file in which lineages are stored across runs, so each
+        tax ID only has to be queried once per taxonomy database
+        (e.g. TAXONOMY_CACHE_FILE). Entries are tied to the path and
+        modification time of the database. If None, no caching is done.
+
+
+    Returns
+    -------
+    taxs : pd.DataFrame
+        dataframe with a tax_ID column for each successfully queried ID,
+        and columns making up all taxonomic ranks covered by NCBI
+        (missing ranks are NaN). These ranks are:
+        'superkingdom', 'phylum', 'genus', 'class', 'subphylum',
+        'family', 'order', 'species'.
+        Rank columns have the pandas "category" dtype; to fill in
+        missing values, add the fill value as a category first
+        (e.g. column.cat.add_categories("Other").fillna("Other")).
+    """
+    tax_ids = np.asarray(tax_ids)
+
+    # filter out invalid IDs upfront so lookups below only
+    # ever see valid integer IDs and do not need to handle errors
+    if not np.issubdtype(tax_ids.dtype, np.integer):
+        ids = pd.Series(tax_ids, dtype=object)
+
+        if np.issubdtype(tax_ids.dtype, np.floating):
+            # only accept integral values, e.g. 562.0
+            ids = pd.to_numeric(ids)
+            valid_mask = (ids.notna() & (ids % 1 == 0)).to_numpy()
+        else:
+            # only accept integer strings (like int() does), rather than
+            # truncating values such as "562.7" or "9.606e3"
+            valid_mask = ids.astype(str).str.fullmatch(
+                r'\s*\d+\s*'
+            ).to_numpy(dtype=bool)
+            ids = pd.to_numeric(ids.where(valid_mask), errors='coerce')
+
+        for tax_id in tax_ids[~valid_mask]:
+            print('Warning: invalid tax_id {0}'.format(tax_id))
+
+        tax_ids = ids[valid_mask].to_numpy(dtype='int64')
+
+    # deduplicate once, so every lookup path below returns a single
+    # row per ID; sqlite cannot bind numpy integers, so convert here
+    tax_ids = pd.unique(tax_ids.astype('int64')).tolist()
+
+    if cache_file is not None:
+        cached_taxs, tax_ids = _read_lineage_cache(
+            tax_ids, cache_file, ncbi.dbfile
+        )
+    else:
+        cached_taxs = _lineage_frame([])
+
+    n_workers = os.cpu_count() or 1
+
+    if len(tax_ids) < PARALLEL_LOOKUP_THRESHOLD or n_workers == 1:
+        taxs, missing = _query_lineages(tax_ids, ncbi.dbfile)
+        taxs = [taxs]
+    else:
+        # lookups are bound by sqlite reads, so overlap them in threads
+        chunks = _chunked(tax_ids, -(-len(tax_ids) // n_workers))
+
+        taxs, missing = [], []
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            for chunk_taxs, chunk_missing in executor.map(
+                _query_lineages, chunks, [ncbi.dbfile] * len(chunks)
+            ):
+                taxs.append(chunk_taxs)
+                missing.extend(chunk_missing)
+
+    # IDs not in the species table directly (e.g. merged IDs)
+    # are resolved through the regular NCBITaxa API
+    taxs.append(_query_lineages_ete3(missing, ncbi))
+    taxs = pd.concat(taxs)
+
+    if cache_file is not None:
+        _write_lineage_cache(taxs, cache_file, ncbi.dbfile)
+
+    # combine cached and newly queried lineages only once
+    taxs = pd.concat([taxs, cached_taxs])
+
+    # few distinct names per rank, so categorical codes make the
+    # subsequent join and groupby much cheaper than object columns
+    for c in taxs.columns:
+        taxs[c] = taxs[c].astype("category")
+
+    # only successfully queried IDs have rows, so the key is
+    # returned with them rather than relying on positional alignment
+    return taxs.reset_index()
+
+
+def get_taxa(annotation, aln_format, database_file=PATH_TO_NCBI_TAXA_DATABASE,
+             cache_file=None):
     """
     Helper function for loading taxa from an DataFrame of annotations.
 
@@ -108,18 +538,36 @@ def get_taxa(annotation, aln_format, database_file=PATH_TO_NCBI_TAXA_DATABASE):
             file difference enough to figure out whether or not taxids will be included
     database_file : string
         TODO: # dbfile="/path/to/taxa.sqlite" 
+    cache_file : string, optional (default: None)
+        sqlite file for caching lineages across runs
+        (e.g. TAXONOMY_CACHE_FILE), see load_taxonomy_lineage.
+        If None, no caching is done.
 
     Returns
     -------
     annotation: pd.DataFrame
         Original annotations alignment, modified to include taxanomic 
-        information for each sequence of the alignment. 
+        information for each sequence of the alignment. Adds a nullable
+        integer (Int64) tax_ID column and one column per rank in
+        TAXONOMY_RANKS, which have the pandas "category" dtype (see
+        load_taxonomy_lineage for how to fill missing values).
     """
     if aln_format != "stockholm":
         pass
         # TODO: Fix the formatting
 
-    annotation['tax_ID'] = annotation['Tax'].str.split('=').str[-1]
+    # tax ID is the number after the last "=" in the Tax annotation;
+    # store as (nullable) integer so lookups and the join key are cheap
+    annotation['tax_ID'] = pd.to_numeric(
+        annotation['Tax'].astype(_STRING_DTYPE).str.extract(
+            r'=\s*(\d+)\s*$', expand=False
+        ),
+        errors='coerce'
+    ).astype('Int64')
+
+    invalid = annotation['Tax'].notna() & annotation['tax_ID'].isna()
+    for tax in annotation.loc[invalid, 'Tax'].unique():
+        print('Warning: invalid tax_id in annotation {0}'.format(tax))
     # TODO: check whether these columns are the same for 
     # uniprot vs uniref vs metagenomics: 
     # do the Tax IDs always get represented in this format?
@@ -133,22 +581,143 @@ def get_taxa(annotation, aln_format, database_file=PATH_TO_NCBI_TAXA_DATABASE):
     # pull in that name properly so as to be consistent with database used and 
     # other config settings, based on `extract_header_annotation` function.
 
-    ncbi = NCBITaxa(dbfile=database_file)  
+    ncbi = _get_ncbi(database_file)
     # TODO: figure out where this ends up getting downloaded, and
     # make sure it downloads once! can make it similar to SIFTS.py
 
     # TODO: should this be integrated w/ update_database.py?
     # doesn't have to be called in there but can be stored there
 
-    tax_ids = annotation['tax_ID'].unique().tolist()
+    tax_ids = np.unique(annotation['tax_ID'].dropna().to_numpy(dtype='int64'))
 
-    taxs = load_taxonomy_lineage(tax_ids, ncbi)
+    taxs = load_taxonomy_lineage(tax_ids, ncbi, cache_file=cache_file)
 
-    annotation = annotation.merge(taxs, on='tax_ID', how='left')
+    annotation = annotation.merge(taxs, on='tax_ID', how='left', validate='m:1')
     
     return annotation
 
 
+def _fill_rank(column, value="Other"):
+    """
+    Fill missing entries of a (possibly categorical) rank column
+    """
+    if (isinstance(column.dtype, pd.CategoricalDtype) and
+            value not in column.cat.categories):
+        column = column.cat.add_categories(value)
+
+    return column.fillna(value)
+
+
+def _sunburst_nodes(agg, hier):
+    """
+    Build the node tree of a sunburst plot from aggregated counts.
+
+    Parameters
+    ----------
+    agg : pd.DataFrame
+        One row per unique path through the ranks in hier,
+        with number of sequences in column "count"
+    hier : Python list
+        1D list of ranks, ordered from highest to lowest
+
+    Returns
+    -------
+    ids, labels, parents, values, roots : Python lists
+        Node IDs ("/"-joined path), node labels, IDs of parent
+        nodes ("" for the innermost ring), summed counts of each
+        node, and top rank entry each node belongs to (for coloring)
+    """
+    # aggregated table is small, so convert (categorical) ranks
+    # to strings once here to build node IDs by concatenation
+    agg = agg.astype({c: str for c in hier})
+
+    ids, labels, parents, values, roots = [], [], [], [], []
+
+    for depth in range(len(hier)):
+        level = agg.groupby(
+            hier[:depth + 1], sort=False
+        )["count"].sum().reset_index()
+
+        node_ids = level[hier[0]]
+        parent_ids = pd.Series([""] * len(level))
+        for c in hier[1:depth + 1]:
+            parent_ids = node_ids
+            node_ids = node_ids + "/" + level[c]
+
+        ids.extend(node_ids.tolist())
+        parents.extend(parent_ids.tolist())
+        labels.extend(level[hier[depth]].tolist())
+        values.extend(level["count"].tolist())
+        roots.extend(level[hier[0]].tolist())
+
+    return ids, labels, parents, values, roots
+
+
+def _aggregate_default(ranks):
+    """
+    Count sequences per unique (superkingdom, phylum, order) path
+    for the default SUNBURST_HIERARCHY.
+
+    Specialization of the generic groupby in sunburst: the codes of
+    the three categorical ranks are combined into a single integer
+    key per sequence, which is counted with one np.unique call.
+
+    Parameters
+    ----------
+    ranks : pd.DataFrame
+        Rank columns of SUNBURST_HIERARCHY, without missing values
+
+    Returns
+    -------
+    agg : pd.DataFrame
+        One row per unique path, with number of
+        sequences in column "count"
+    """
+    kingdom, phylum, order = (
+        ranks[c].astype("category").cat for c in SUNBURST_HIERARCHY
+    )
+    n_phyla, n_orders = len(phylum.categories), len(order.categories)
+
+    keys = (
+        kingdom.codes.astype(np.int64) * n_phyla + phylum.codes
+    ) * n_orders + order.codes
+    keys, counts = np.unique(keys, return_counts=True)
+
+    kingdom_codes, rest = np.divmod(keys, n_phyla * n_orders)
+    phylum_codes, order_codes = np.divmod(rest, n_orders)
+
+    return pd.DataFrame({
+        SUNBURST_HIERARCHY[0]: kingdom.categories.take(kingdom_codes),
+        SUNBURST_HIERARCHY[1]: phylum.categories.take(phylum_codes),
+        SUNBURST_HIERARCHY[2]: order.categories.take(order_codes),
+        "count": counts,
+    })
+
+
+def _sunburst_figure(ids, labels, parents, values, roots, title, color_map):
+    """
+    Create sunburst figure from precomputed node tree
+    (cf. _sunburst_nodes for arguments)
+    """
+    # resolve colors once per distinct top rank entry and
+    # broadcast to all nodes through the categorical codes
+    roots = pd.Categorical(roots)
+    other = color_map.get("Other", COLOR_DISCRETE_MAP["Other"])
+    palette = np.array(
+        [color_map.get(c, other) for c in roots.categories],
+        dtype=object
+    )
+
+    fig = go.Figure(go.Sunburst(
+        ids=ids, labels=labels, parents=parents, values=values,
+        branchvalues="total",
+        marker=dict(colors=palette[roots.codes])
+    ))
+    fig.update_layout(title=title)
+
+    return fig
+
+
 def sunburst(annotation, title, hier=SUNBURST_HIERARCHY, color_map=COLOR_DISCRETE_MAP):
 
     # keyword argument for hier if confident?
@@ -192,15 +761,25 @@ def sunburst(annotation, title, hier=SUNBURST_HIERARCHY, color_map=COLOR_DISCRET
 
     # plotly will throw an error if any intermediate rank entries are empty, so 
     # we must fill in the empty intermediate ranks so as not to lose any hits. 
-    annotation.fillna("Other", inplace = True) # for purposes of filling in empty intermediate ranks.
-    
-    annotation["count"] = 1 # a helper column for providing "counts" to plotting function.
-    
-    fig = px.sunburst(annotation, path=hier, values='count', 
-                      title = title, color=hier[0],
-                      color_discrete_map=color_map) 
-                                        
-    return fig
+    # only the plotted ranks need filling, and the caller's dataframe is left untouched.
+    ranks = pd.DataFrame({c: _fill_rank(annotation[c]) for c in hier})
+
+    # aggregate to one row per unique rank path so plotly only has to
+    # traverse the distinct branches rather than every sequence
+    if hier == SUNBURST_HIERARCHY:
+        agg = _aggregate_default(ranks)
+    else:
+        agg = ranks.groupby(
+            hier, dropna=False, sort=False, observed=True
+        ).size().reset_index(name="count")
+
+    # pass the tree to plotly directly rather than having
+    # plotly express derive it from the path columns
+    ids, labels, parents, values, roots = _sunburst_nodes(agg, hier)
+
+    return _sunburst_figure(
+        ids, labels, parents, values, roots, title, color_map
+    )
        
 
 
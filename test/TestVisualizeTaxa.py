@@ -0,0 +1,283 @@
+import io
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+import pandas as pd
+
+from ete3 import NCBITaxa
+from ete3.ncbi_taxonomy.ncbiquery import DB_VERSION
+
+from evcouplings.visualize.taxa import (
+    COLOR_DISCRETE_MAP, SUNBURST_HIERARCHY, get_taxa,
+    load_taxonomy_lineage, sunburst, _aggregate_default
+)
+
+# (taxid, parent, name, rank) of a minimal NCBI taxonomy
+SPECIES = [
+    (1, 1, "root", "no rank"),
+    (2, 1, "Bacteria", "superkingdom"),
+    (1224, 2, "Proteobacteria", "phylum"),
+    (91347, 1224, "Enterobacterales", "order"),
+    (561, 91347, "Escherichia", "genus"),
+    (562, 561, "Escherichia coli", "species"),
+    (2759, 1, "Eukaryota", "superkingdom"),
+    (9606, 2759, "Homo sapiens", "species"),
+]
+
+# taxid 999 was merged into 562
+MERGED = [(999, 562)]
+
+
+def create_taxa_database(filename):
+    """
+    Create sqlite file with the same schema as NCBITaxa
+    """
+    parents = {taxid: parent for taxid, parent, _, _ in SPECIES}
+
+    def track(taxid):
+        lineage = [taxid]
+        while lineage[-1] != 1:
+            lineage.append(parents[lineage[-1]])
+        return ",".join(map(str, lineage))
+
+    con = sqlite3.connect(filename)
+    con.executescript("""
+        CREATE TABLE stats (version INT PRIMARY KEY);
+        CREATE TABLE species (taxid INT PRIMARY KEY, parent INT, spname VARCHAR(50) COLLATE NOCASE, common VARCHAR(50) COLLATE NOCASE, rank VARCHAR(50), track TEXT);
+        CREATE TABLE synonym (taxid INT,spname VARCHAR(50) COLLATE NOCASE, PRIMARY KEY (spname, taxid));
+        CREATE TABLE merged (taxid_old INT, taxid_new INT);
+    """)
+    con.execute("INSERT INTO stats (version) VALUES (?)", (DB_VERSION,))
+    con.executemany(
+        "INSERT INTO species VALUES (?, ?, ?, '', ?, ?)",
+        [(t, p, name, rank, track(t)) for t, p, name, rank in SPECIES]
+    )
+    con.executemany("INSERT INTO merged VALUES (?, ?)", MERGED)
+    con.commit()
+    con.close()
+
+
+class TestVisualizeTaxa(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.database_file = os.path.join(self.tmp_dir.name, "taxa.sqlite")
+        self.cache_file = os.path.join(self.tmp_dir.name, "cache", "lineage.sqlite")
+        create_taxa_database(self.database_file)
+        self.ncbi = NCBITaxa(dbfile=self.database_file)
+
+    def tearDown(self):
+        self.ncbi.db.close()
+        self.tmp_dir.cleanup()
+
+    def _species(self, taxs):
+        return dict(zip(taxs.tax_ID.tolist(), taxs.species.astype(object).tolist()))
+
+    def test_load_taxonomy_lineage_cached(self):
+        """
+        Test whether cached lineages are identical to uncached ones
+        """
+        expected = load_taxonomy_lineage([562, 9606], self.ncbi)
+
+        first = load_taxonomy_lineage([562, 9606], self.ncbi, cache_file=self.cache_file)
+        self.assertTrue(os.path.exists(self.cache_file))
+        second = load_taxonomy_lineage([562, 9606], self.ncbi, cache_file=self.cache_file)
+
+        for taxs in (first, second):
+            self.assertEqual(
+                expected.sort_values("tax_ID").astype(object).values.tolist(),
+                taxs.sort_values("tax_ID").astype(object).values.tolist()
+            )
+
+    def test_load_taxonomy_lineage_cache_database_update(self):
+        """
+        Test that the cache does not return lineages from an outdated database
+        """
+        load_taxonomy_lineage([9606], self.ncbi, cache_file=self.cache_file)
+
+        con = sqlite3.connect(self.database_file)
+        con.execute("UPDATE species SET spname = 'RENAMED' WHERE taxid = 9606")
+        con.commit()
+        con.close()
+        stat = os.stat(self.database_file)
+        os.utime(self.database_file, (stat.st_atime, stat.st_mtime + 10))
+
+        taxs = load_taxonomy_lineage([9606], self.ncbi, cache_file=self.cache_file)
+        self.assertEqual(self._species(taxs), {9606: "RENAMED"})
+
+    def test_load_taxonomy_lineage_cache_unavailable(self):
+        """
+        Test that lookups still succeed if the cache cannot be created
+        """
+        # parent "directory" of cache is a file, so cache cannot be written
+        cache_file = os.path.join(self.database_file, "lineage.sqlite")
+        taxs = load_taxonomy_lineage([562], self.ncbi, cache_file=cache_file)
+        self.assertEqual(self._species(taxs), {562: "Escherichia coli"})
+
+    def test_load_taxonomy_lineage_merged(self):
+        """
+        Test lookup of IDs that are only in the merged table
+        """
+        taxs = load_taxonomy_lineage([999], self.ncbi)
+        self.assertEqual(self._species(taxs), {999: "Escherichia coli"})
+
+    def test_load_taxonomy_lineage_merged_database_update(self):
+        """
+        Test that lookups of merged IDs reflect updates of the database
+        """
+        load_taxonomy_lineage([999], self.ncbi)
+
+        con = sqlite3.connect(self.database_file)
+        con.execute("UPDATE species SET spname = 'RENAMED' WHERE taxid = 562")
+        con.commit()
+        con.close()
+        stat = os.stat(self.database_file)
+        os.utime(self.database_file, (stat.st_atime, stat.st_mtime + 10))
+
+        taxs = load_taxonomy_lineage([999], self.ncbi)
+        self.assertEqual(self._species(taxs), {999: "RENAMED"})
+
+    def test_load_taxonomy_lineage_unknown(self):
+        """
+        Test that unknown IDs result in an empty table rather than an error
+        """
+        taxs = load_taxonomy_lineage([12345], self.ncbi)
+        self.assertEqual(len(taxs), 0)
+        self.assertIn("species", taxs.columns)
+
+    def test_load_taxonomy_lineage_cached_unknown(self):
+        """
+        Test repeated lookup where all known IDs are cached already
+        """
+        load_taxonomy_lineage([562, 12345], self.ncbi, cache_file=self.cache_file)
+        taxs = load_taxonomy_lineage([562, 12345], self.ncbi, cache_file=self.cache_file)
+        self.assertEqual(self._species(taxs), {562: "Escherichia coli"})
+
+    def test_get_taxa(self):
+        """
+        Test whether lineages are added to annotation of each sequence
+        """
+        annotation = pd.DataFrame({
+            "id": ["a", "b", "c"],
+            "Tax": ["Escherichia coli TaxID=562", "Homo sapiens TaxID=9606", "TaxID=562"],
+        })
+        annotation = get_taxa(annotation, "stockholm", database_file=self.database_file)
+
+        self.assertEqual(annotation.tax_ID.tolist(), [562, 9606, 562])
+        self.assertEqual(
+            annotation.superkingdom.astype(object).tolist(),
+            ["Bacteria", "Eukaryota", "Bacteria"]
+        )
+
+    def test_get_taxa_invalid_tax_id(self):
+        """
+        Test that invalid or out-of-range tax IDs are reported and
+        do not resolve to any lineage
+        """
+        annotation = pd.DataFrame({
+            "id": ["a", "b", "c", "d"],
+            "Tax": ["TaxID=562", "TaxID=unknown", "TaxID=99999999999", None],
+        })
+        with patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            annotation = get_taxa(annotation, "stockholm", database_file=self.database_file)
+
+        self.assertIn("TaxID=unknown", stdout.getvalue())
+        self.assertEqual(
+            annotation.tax_ID.astype(object).where(annotation.tax_ID.notna(), None).tolist(),
+            [562, None, 99999999999, None]
+        )
+        self.assertEqual(
+            annotation.superkingdom.astype(object).where(annotation.superkingdom.notna(), None).tolist(),
+            ["Bacteria", None, None, None]
+        )
+
+    def test_load_taxonomy_lineage_invalid_tax_id(self):
+        """
+        Test that non-integer tax IDs are reported and skipped
+        rather than truncated to a valid ID
+        """
+        with patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            taxs = load_taxonomy_lineage(
+                ["562.7", "9.606e3", "unknown", " 9606 "], self.ncbi
+            )
+
+        for tax_id in ["562.7", "9.606e3", "unknown"]:
+            self.assertIn(tax_id, stdout.getvalue())
+        self.assertEqual(self._species(taxs), {9606: "Homo sapiens"})
+
+    def test_sunburst_custom_color_map(self):
+        """
+        Test that color maps do not need to define a color for "Other"
+        """
+        annotation = pd.DataFrame({
+            "superkingdom": ["Bacteria", "Eukaryota", None],
+            "phylum": ["Proteobacteria", None, None],
+            "order": ["Enterobacterales", None, None],
+        })
+        fig = sunburst(annotation, "test", color_map={"Bacteria": "#000000"})
+        colors = dict(zip(fig.data[0].ids, fig.data[0].marker.colors))
+
+        self.assertEqual(colors["Bacteria"], "#000000")
+        self.assertEqual(colors["Eukaryota"], COLOR_DISCRETE_MAP["Other"])
+        self.assertEqual(colors["Other/Other"], COLOR_DISCRETE_MAP["Other"])
+
+    def test_sunburst_nodes(self):
+        """
+        Test whether sunburst tree is built correctly from sequence ranks
+        """
+        annotation = pd.DataFrame({
+            "superkingdom": ["Bacteria", "Bacteria", "Bacteria", "Eukaryota"],
+            "phylum": ["Proteobacteria", "Proteobacteria", "Firmicutes", None],
+            "order": ["Enterobacterales", "Vibrionales", None, "Primates"],
+        }).astype("category")
+        fig = sunburst(annotation, "test")
+        nodes = {
+            node_id: (parent, label, value) for node_id, parent, label, value in zip(
+                fig.data[0].ids, fig.data[0].parents, fig.data[0].labels, fig.data[0].values
+            )
+        }
+
+        self.assertEqual(nodes, {
+            "Bacteria": ("", "Bacteria", 3),
+            "Eukaryota": ("", "Eukaryota", 1),
+            "Bacteria/Proteobacteria": ("Bacteria", "Proteobacteria", 2),
+            "Bacteria/Firmicutes": ("Bacteria", "Firmicutes", 1),
+            "Eukaryota/Other": ("Eukaryota", "Other", 1),
+            "Bacteria/Proteobacteria/Enterobacterales": ("Bacteria/Proteobacteria", "Enterobacterales", 1),
+            "Bacteria/Proteobacteria/Vibrionales": ("Bacteria/Proteobacteria", "Vibrionales", 1),
+            "Bacteria/Firmicutes/Other": ("Bacteria/Firmicutes", "Other", 1),
+            "Eukaryota/Other/Primates": ("Eukaryota/Other", "Primates", 1),
+        })
+
+        # node IDs must be unique for plotly
+        self.assertEqual(len(fig.data[0].ids), len(nodes))
+
+    def test_aggregate_default(self):
+        """
+        Test that specialized aggregation for the default hierarchy
+        gives the same counts as the generic groupby
+        """
+        ranks = pd.DataFrame({
+            "superkingdom": ["Bacteria", "Bacteria", "Eukaryota", "Bacteria", "Other"],
+            "phylum": ["Proteobacteria", "Firmicutes", "Other", "Proteobacteria", "Other"],
+            "order": ["Enterobacterales", "Other", "Primates", "Enterobacterales", "Other"],
+        })
+
+        for dtype in (object, "category"):
+            ranks = ranks.astype(dtype)
+            generic = ranks.groupby(
+                SUNBURST_HIERARCHY, observed=True
+            ).size().reset_index(name="count")
+
+            self.assertEqual(
+                sorted(map(tuple, _aggregate_default(ranks).astype(object).values.tolist())),
+                sorted(map(tuple, generic.astype(object).values.tolist()))
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()